@@ -6,12 +6,64 @@ Created on Fri Mar  5 11:22:05 2021
 """
 
 import asapgpu as asapGPU
-import scipy.sparse as ssp
 import torch
 import numpy as np
 
 SIGMA_JOD = 1.4826
 
+class SparseCompMat:
+    """
+    Comparison matrix for the active-learning loop, held by the caller in place of a plain ndarray.
+    Next to the dense matrix, it keeps the non-zero counts as NumPy arrays sorted by flat index
+    a*size+b (i.e. in row-major order): an update is a binary search, plus an insertion for a new pair.
+    The (3, nnz) comparison tensor consumed by true_skill is rebuilt from these arrays, in O(nnz)
+    vectorized work, only when an update happened since the last inference.
+    It also keeps the pairs of the last ASAP prediction not served yet by predictNext, with the useBatch
+    they were predicted for, and the number of updates done since.
+
+    The dense matrix is available as `matrix` (e.g. to save it), but it must only be modified
+    through updateCompMat: other modifications are not seen by the cached comparison tensor.
+    """
+
+    def __init__(self, compMat):
+        self.matrix = np.array(compMat)
+        rows, cols = self.matrix.shape
+        if rows != cols:
+            raise ValueError("The comparison matrix must be square.")
+
+        self.size = rows
+        self.__keys = np.flatnonzero(self.matrix).astype(np.int64)
+        self.__counts = self.matrix.ravel()[self.__keys].astype(np.int64)
+        self.__comparisons = None
+        self.__dirty = True
+        self.pendingPairs = []
+        self.pendingPairsBatch = None
+        self.pendingUpdates = 0
+
+    def increment(self, idx):
+        self.matrix[idx[0], idx[1]] += 1
+        key = int(idx[0]) * self.size + int(idx[1])
+        pos = np.searchsorted(self.__keys, key)
+        if pos < len(self.__keys) and self.__keys[pos] == key:
+            self.__counts[pos] += 1
+        else:
+            self.__keys = np.insert(self.__keys, pos, key)
+            self.__counts = np.insert(self.__counts, pos, 1)
+        self.__dirty = True
+        self.pendingUpdates += 1
+
+    def comparisons(self, device):
+        """
+        Returns the G(rows: condition1, condition2, comparison_outcomes, cols: pairing_combination) tensor of true_skill.
+        """
+        if self.__dirty or self.__comparisons.device.type != device:
+            rows, cols = np.divmod(self.__keys, self.size)
+            # copy of the counts: they are incremented in place by the next updates
+            self.__comparisons = torch.from_numpy(np.stack((rows, cols, self.__counts))).to(device)
+            self.__dirty = False
+
+        return self.__comparisons
+
 def updateCompMat(idx, compMat):
     """
     Updates the comparison matrix with new comparison output. 
@@ -20,6 +72,8 @@ def updateCompMat(idx, compMat):
     ----------
     idx : tuple
         index with the form (a,b) where always compMat[a,b] += 1.
+    compMat : np.ndarray or SparseCompMat
+        comparison matrix, a SparseCompMat keeps its cached sparse copy up to date.
 
     Returns
     -------
@@ -27,33 +81,85 @@ def updateCompMat(idx, compMat):
 
     """ 
     if idx:
-        compMat[idx[0], idx[1]] += 1
+        if isinstance(compMat, SparseCompMat):
+            compMat.increment(idx)
+        else:
+            compMat[idx[0], idx[1]] += 1
     
     return compMat 
    
-def predictNext(compMat, useCuda=False, useBatch=True, **kwargs):
-    return asapGPU.ASAP(compMat, mst_mode=useBatch, cuda=useCuda).tolist()    
-    
-def inferScores(compMat, useCuda=False):
-    # Create a sparse matrix
-    sparseCompMat = ssp.coo_matrix(compMat)
+def predictNext(compMat, useCuda=False, useBatch=True, minBatchBeforeAsap=1, **kwargs):
+    """
+    Predicts the next pairs to compare with ASAP. 
+
+    Parameters
+    ----------
+    compMat : np.ndarray or SparseCompMat
+        comparison matrix, updated with updateCompMat.
+    useCuda : bool
+        run ASAP on GPU. It only pays off on large matrices, the kernel launches dominate otherwise.
+    useBatch : bool
+        predict a batch of pairs (minimum spanning tree) instead of a single pair.
+    minBatchBeforeAsap : int
+        number of comparisons to add with updateCompMat before ASAP is run again (SparseCompMat only,
+        ValueError otherwise). ASAP is a global pass over all the pairs: when it is greater than 1,
+        one ASAP run predicts several pairs (the spanning tree with useBatch, the minBatchBeforeAsap
+        pairs with the largest information gains otherwise), which are then served one per call
+        and never twice. ASAP is run again once they are all served or after minBatchBeforeAsap updates.
+
+    Returns
+    -------
+    list of pairs to compare (a single pair when minBatchBeforeAsap is greater than 1).
+
+    """
+    if minBatchBeforeAsap <= 1:
+        matrix = compMat.matrix if isinstance(compMat, SparseCompMat) else np.asarray(compMat)
+        return asapGPU.ASAP(matrix, mst_mode=useBatch, cuda=useCuda).tolist()
 
-    # Check that the matrix is square
-    rows, cols = sparseCompMat.shape
+    if not isinstance(compMat, SparseCompMat):
+        raise ValueError("minBatchBeforeAsap needs a SparseCompMat, which keeps the predicted pairs between calls.")
+
+    # pairs predicted for the other mode (batch or single pair) cannot be reused
+    if not compMat.pendingPairs or compMat.pendingPairsBatch != useBatch or compMat.pendingUpdates >= minBatchBeforeAsap:
+        compMat.pendingPairs = asapGPU.ASAP(compMat.matrix, mst_mode=useBatch, cuda=useCuda, num_pairs=minBatchBeforeAsap).tolist()
+        compMat.pendingPairsBatch = useBatch
+        compMat.pendingUpdates = 0
     
-    if rows != cols:
-        raise ValueError("The comparison matrix must be square.")
+    # a served pair is dropped: it is not proposed again before the next ASAP run
+    return [compMat.pendingPairs.pop(0)]    
     
-    # convert the matrix to tensor to have G(rows: condition1, condition2, comparison_outcomes, cols: pairing_combination) 
-    compTensor = torch.stack((
-        torch.tensor(sparseCompMat.row).long(),
-        torch.tensor(sparseCompMat.col).long(),
-        torch.tensor(sparseCompMat.data).long(),
-    ))
+@torch.no_grad()
+def inferScores(compMat, useCuda=False):
+    """
+    Infers the score distributions of all the images from a comparison matrix
+    (np.ndarray, nested lists, or SparseCompMat to reuse its cached comparison tensor).
+    """
+    device = "cuda" if useCuda else "cpu"
+    if isinstance(compMat, SparseCompMat):
+        # comparison tensor, only rebuilt after updates
+        rows = compMat.size
+        compTensor = compMat.comparisons(device)
+
+    else:
+        compMat = np.asarray(compMat)
+
+        # Check that the matrix is square
+        rows, cols = compMat.shape
+        
+        if rows != cols:
+            raise ValueError("The comparison matrix must be square.")
+        
+        # convert the matrix to tensor to have G(rows: condition1, condition2, comparison_outcomes, cols: pairing_combination) 
+        # the counts are cast to int64 on the host: torch cannot convert every NumPy dtype (e.g. uint32 before torch 2.3)
+        nonZeroRows, nonZeroCols = np.nonzero(compMat)
+        compTensor = torch.from_numpy(np.stack((
+            nonZeroRows,
+            nonZeroCols,
+            compMat[nonZeroRows, nonZeroCols].astype(np.int64),
+        )))
 
-    # Put on GPU if available
-    if useCuda:
-        compTensor = compTensor.cuda()
+        # Put on GPU if available
+        compTensor = compTensor.to(device)
 
     # Compute the scores distributions for all the images (stimulis)
     scoreNormalDistList = asapGPU.true_skill(compTensor, rows)
@@ -65,11 +171,11 @@ def JODScores(compMat, useCuda=False, shiftToRefImage=False):
     scoreNormalDistList = inferScores(compMat, useCuda)
     
     # Get the mean and std for every image
-    meanList = scoreNormalDistList.mean.cpu().detach().numpy().tolist()
-    stdList = np.sqrt(scoreNormalDistList.variance.cpu().detach().numpy()).tolist()
+    meanArr = scoreNormalDistList.mean.detach().cpu().numpy()
+    stdArr = scoreNormalDistList.stddev.detach().cpu().numpy()
     
     # Get the normalized JOD scores
-    JOD, JODstd = normalizeScale(meanList, stdList, shiftToRefImage)
+    JOD, JODstd = normalizeScale(meanArr, stdArr, shiftToRefImage)
     
     return JOD, JODstd
 
@@ -81,13 +187,18 @@ def normalizeScale(score, scoreStd=None, shiftToRefImage=False):
         Since the True_Skill gives us the score in a different scaling, we must:
             - first normalize, to align ourselves with the inverse function of a normal distribution;
             - Then, multiply by 1.4826 to get 1 JOD = 1
+        score and scoreStd are ndarrays (lists are converted), the outputs are ndarrays.
     """
-    normalizedScore = (score - np.mean(score))/np.std(score) * SIGMA_JOD
+    score = np.asarray(score, dtype=np.float64)
+    # mean and std from the sum and the sum of squares: np.std would recompute the mean in another pass
+    scoreMean = score.sum() / score.size
+    scoreScale = SIGMA_JOD / np.sqrt(max(np.dot(score, score) / score.size - scoreMean * scoreMean, 0.0))
+    normalizedScore = (score - scoreMean) * scoreScale
     if shiftToRefImage:
         # JOD is relative ==> we suppose r1=0
         normalizedScore -= normalizedScore[0]
-    if scoreStd:
-        normalizedScorestd = scoreStd/np.std(score) * SIGMA_JOD
+    if scoreStd is not None:
+        normalizedScorestd = np.asarray(scoreStd, dtype=np.float64) * scoreScale
         return normalizedScore, normalizedScorestd
     return normalizedScore
     
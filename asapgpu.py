@@ -1,10 +1,10 @@
 '''
 Code source (edited): https://github.com/gfxdisp/asap 
 '''
+import functools
 import torch
 import torch.distributions as dist
 import numpy as np
-import scipy.sparse as ssp
 import networkx as nx
 import random
 
@@ -128,10 +128,30 @@ def get_maximum(gain_mat):
     pair_to_compare = np.expand_dims(result[random.randint(0,np.shape(result)[0]-1),:],0)
     return pair_to_compare
 
-def ASAP(cmp_matrix: np.ndarray, mst_mode=True, cuda=False):
+def get_top_pairs(gain_mat, num_pairs):
+    '''
+    Function to find the num_pairs pairs of conditions with the largest gains in the information gain matrix (ties are broken at random). 
+    The matrix is symmetric: every pair is only considered once.
+    '''
+    rows, cols = np.triu_indices(np.shape(gain_mat)[0], k=1)
+    order = np.random.permutation(len(rows))
+    order = order[np.argsort(-gain_mat[rows[order], cols[order]], kind='stable')[:num_pairs]]
+    return np.stack((rows[order], cols[order]), axis=1)
+
+@functools.lru_cache(maxsize=None)
+def off_diagonal_pairs(M: int, device: torch.device):
+    '''
+    Indices (I, J) of all the pairs of distinct conditions, i.e. of all the possible next comparisons.
+    They only depend on M and the device: ASAP is called many times with the same M during an experiment,
+    so they are built once per (M, device) and reused. The returned tensors must not be modified.
+    '''
+    return torch.nonzero((1 - torch.eye(M, device=device)), as_tuple=False).unbind(-1)
+
+def ASAP(cmp_matrix: np.ndarray, mst_mode=True, cuda=False, num_pairs=1):
     '''
 
     Function to compute the next batch of comparisons to perform. 
+    Without mst_mode, the num_pairs pairs with the largest information gains are returned (one by default).
 
     Note: in current implementation selective EIG evaluations are not implemented.
     This does not impact the accuracy of the algorithm.
@@ -149,15 +169,16 @@ def ASAP(cmp_matrix: np.ndarray, mst_mode=True, cuda=False):
         return np.array(pairs_to_compare)
         
 
-    # Create a sparse matrix
-    cmp_matrix = ssp.coo_matrix(cmp_matrix)
+    # Get the non-zero comparisons (COO)
+    rows, cols = np.nonzero(cmp_matrix)
 
 
     # convert the matrix to tensor to have G(rows: condition1, condition2, comparison_outcomes, cols: pairing_combination) 
     G0 = torch.stack((
-        torch.tensor(cmp_matrix.row).long(),
-        torch.tensor(cmp_matrix.col).long(),
-        torch.tensor(cmp_matrix.data).long(),
+        torch.from_numpy(rows).long(),
+        torch.from_numpy(cols).long(),
+        # int64 on the host: torch cannot convert every NumPy dtype (e.g. uint32 before torch 2.3)
+        torch.from_numpy(np.asarray(cmp_matrix)[rows, cols].astype(np.int64)),
     ))
 
     # Put on GPU if available
@@ -168,7 +189,7 @@ def ASAP(cmp_matrix: np.ndarray, mst_mode=True, cuda=False):
     normal0 = true_skill(G0, M)
     
     # tensor to hold each possible pairwise outcome in the next comparison
-    I, J = torch.nonzero((1 - torch.eye(M)).to(G0.device), as_tuple=False).unbind(-1)
+    I, J = off_diagonal_pairs(M, G0.device)
     G = torch.zeros(G0.size(0),I.size(0),G0.size(1)+1).to(G0)
     G[:,:,:-1] = G0.unsqueeze(-2)
     G[0,:,-1] = I
@@ -195,6 +216,9 @@ def ASAP(cmp_matrix: np.ndarray, mst_mode=True, cuda=False):
     if mst_mode:    
         # minial spanning tree for batch mode
         pairs_to_compare = compute_minimum_spanning_tree(info_gain)
+    elif num_pairs > 1:
+        # several single pairs from one run, ranked by information gain
+        pairs_to_compare = get_top_pairs(info_gain, num_pairs)
     else:
         pairs_to_compare = get_maximum(info_gain)
     
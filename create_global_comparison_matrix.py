@@ -1,51 +1,101 @@
 # pylint: disable=wrong-import-position
 
+import concurrent.futures
 import os
 import numpy as np
+import indexkernels
 from lockfile import FileLocker
 
-def computeCommonCompDict(resultsPath, dataPath, experiment):
+def _readUserMatrix(userMatrix):
     '''
-    Sum all individuals results to compute the common matrix
+    Read the comparison matrix and the list of files of one user, under lock.
+    Returns None if the file is incomplete or cannot be read.
+    '''
+    with FileLocker(userMatrix):
+        try:
+            with np.load(userMatrix) as compMatData:
+
+                if not ("COMP_MAT" in compMatData and "LIST_FILES" in compMatData):
+                    print(f"User matrix looks incomplete: {userMatrix}")
+                    return None
+
+                return compMatData["COMP_MAT"], compMatData["LIST_FILES"]
+        except Exception as ex:
+            print(f"Error reading user matrix {userMatrix}. {ex}")
+            return None
+
+def _readUserMatrices(userMatrices, maxWorkers=None):
+    '''
+    Yield (userMatrix, _readUserMatrix(userMatrix)) for all the user matrices, read in parallel by maxWorkers threads.
+    The first readable matrix is read alone and yielded first: its list of files is the reference order.
+    The others are yielded as soon as they are read, at most 2*maxWorkers being read ahead to bound the memory.
+    '''
+    userMatrices = iter(userMatrices)
+    for userMatrix in userMatrices:
+        userData = _readUserMatrix(userMatrix)
+        yield userMatrix, userData
+        if userData is not None:
+            break
+
+    maxWorkers = maxWorkers or min(32, (os.cpu_count() or 1) + 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = {}
+        for userMatrix in userMatrices:
+            if len(futures) >= 2 * maxWorkers:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield futures.pop(future), future.result()
+            futures[executor.submit(_readUserMatrix, userMatrix)] = userMatrix
+
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+def computeCommonCompDict(resultsPath, dataPath, experiment, maxWorkers=None):
+    '''
+    Sum all individuals results to compute the common matrix.
+    The user matrices are read in parallel by maxWorkers threads (I/O bound), and summed as they are read.
     '''
     compDict = {}
     commonCompMat = None
     listFiles = None
-    for file in os.listdir(resultsPath):
-        if "compMat" in file and os.path.splitext(file)[-1] == ".npz": # TODO: implement a better test (robust regex)
-
-            userMatrix = os.path.join(resultsPath, file)
-            userMatrixLocker = FileLocker(userMatrix)
-            userMatrixLocker.lock()
-            try:
-                with np.load(userMatrix, mmap_mode="r") as compMatData:
-
-                    if not ("COMP_MAT" in compMatData and "LIST_FILES" in compMatData):
-                        print(f"User matrix looks incomplete: {userMatrix}")
-                        continue
-
-                    compMatUser = compMatData["COMP_MAT"]
-                    # Check if are the same and well ordered.
-                    if "LIST_FILES" in compMatData:
-                        listFilesForUser = compMatData["LIST_FILES"]
-                        listFiles = listFiles if listFiles is not None else listFilesForUser
-                        if not (listFilesForUser == listFiles).all():
-                            if set(listFilesForUser) != set(listFiles):
-                                raise ValueError(f'The list of images for {experiment} is different from the one used in previous iterations')
-                            # in this case, we have the same images, but the order is different. We need to adapt the compMatData to follow the same order.
-                            newOrder = [np.where(listFilesForUser==value)[0][0] for value in listFiles]
-                            compMatUser = compMatUser[:, newOrder][newOrder]
-                    if commonCompMat is not None:
-                        commonCompMat = np.add(commonCompMat, compMatUser)
-                    else:
-                        commonCompMat = compMatUser
-            except Exception as ex:
-                print(f"Error reading user matrix {userMatrix}. {ex}")
-            userMatrixLocker.unlock()
+    listFilesBytes = None
+    processedComparisons = 0
+    # TODO: implement a better test (robust regex)
+    userMatrixNames = sorted(entry.name for entry in os.scandir(resultsPath) if "compMat" in entry.name and entry.name.endswith(".npz"))
+    userMatrices = [os.path.join(resultsPath, file) for file in userMatrixNames]
+    for userMatrix, userData in _readUserMatrices(userMatrices, maxWorkers):
+        if userData is None:
+            continue
+
+        compMatUser, listFilesForUser = userData
+        try:
+            # Check if are the same and well ordered.
+            if listFiles is None:
+                listFiles, listFilesBytes = listFilesForUser, listFilesForUser.tobytes()
+            # raw bytes comparison (memcmp) for the usual case where all the users share the same list
+            if not (listFilesForUser.dtype == listFiles.dtype and listFilesForUser.tobytes() == listFilesBytes):
+                if set(listFilesForUser) != set(listFiles):
+                    raise ValueError(f'The list of images for {experiment} is different from the one used in previous iterations')
+                # in this case, we have the same images, but the order is different. We need to adapt the compMatData to follow the same order.
+                sorter = np.argsort(listFilesForUser)
+                newOrder = sorter[np.searchsorted(listFilesForUser, listFiles, sorter=sorter)]
+                compMatUser = indexkernels.applyPermutation(compMatUser, newOrder)
+            if commonCompMat is not None:
+                # the cast to uint32 is done chunk by chunk by the ufunc, without a temporary copy of the matrix
+                np.add(commonCompMat, compMatUser, out=commonCompMat, casting="unsafe")
+            else:
+                # the stored matrices are narrow (uint8/uint16): accumulate in a uint32 buffer allocated once
+                commonCompMat = compMatUser.astype(np.uint32)
+            processedComparisons += int(compMatUser.sum(dtype=np.uint64))
+        except Exception as ex:
+            print(f"Error reading user matrix {userMatrix}. {ex}")
 
     if commonCompMat is not None:
+        # a cell which wrapped around in uint32 would make the total differ from the sum of the user totals
+        if int(commonCompMat.sum(dtype=np.uint64)) != processedComparisons:
+            raise OverflowError(f'The common comparison matrix of {experiment} overflows uint32')
         compDict['COMP_MAT'] = commonCompMat
-        compDict['PROCESSED_COMPARISONS'] = np.sum(commonCompMat)
+        compDict['PROCESSED_COMPARISONS'] = processedComparisons
         compDict['LIST_FILES'] = listFiles if listFiles is not None else sorted([img for img in os.listdir(dataPath) if img.lower().endswith(EXTENSIONS)])
 
     return compDict
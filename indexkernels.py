@@ -0,0 +1,40 @@
+# coding: UTF-8
+"""
+Index arithmetic kernels used to reorder user matrices.
+They are JIT-compiled with numba when it is installed and USE_NUMBA is set, NumPy is used otherwise.
+numba is imported on first use, so importing this module stays cheap.
+"""
+import functools
+from types import ModuleType
+from typing import Optional
+
+import numpy as np
+
+USE_NUMBA = True
+
+
+@functools.lru_cache(maxsize=None)
+def _numbaKernels() -> Optional[ModuleType]:
+    try:
+        import numbakernels
+    except ImportError:
+        return None
+
+    return numbakernels
+
+
+def applyPermutation(mat: np.ndarray, perm: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Reorders both the rows and the columns of a square matrix: out[i, j] = mat[perm[i], perm[j]].
+    """
+    kernels = _numbaKernels() if USE_NUMBA else None
+    if kernels is not None:
+        if out is None:
+            out = np.empty((len(perm), len(perm)), dtype=mat.dtype)
+        return kernels.applyPermutation(mat, np.ascontiguousarray(perm, dtype=np.int64), out)
+
+    if out is None:
+        return mat[np.ix_(perm, perm)]
+
+    out[...] = mat[np.ix_(perm, perm)]
+    return out
@@ -3,12 +3,17 @@ import atexit
 import datetime
 import functools
 import os
-import random
-import re
 import tempfile
 import time
+import uuid
 import weakref
-from typing import Any, Callable, List, Optional, TypeVar
+from typing import Any, Callable, Optional, TypeVar
+
+try:
+    import inotify_simple
+except ImportError:
+    # inotify is Linux only: FileLocker falls back to polling
+    inotify_simple = None
 
 R = TypeVar("R") # TODO: use PEP 612 when the framework will be on Python 3.10
 
@@ -17,9 +22,10 @@ class FileLocker:
 
     INSTANCES_LOCKED = weakref.WeakSet()
 
-    _LOCK_FORMAT = r"{}.{:06d}"
-    _LOCK_REGEX_FORMAT = r"{}\.(?P<counter>[0-9]{{6}})"
-    _RAND_RANGE = 10e5
+    _LOCK_FORMAT = r"{}.lock"
+    _GUARD_FORMAT = r"{}.break"
+    _SLEEP_DURATION = 0.5
+    _GUARD_SLEEP_DURATION = 0.01
 
     def __init__(self, path: str, timeout: int = 20) -> None:
         self.timeout = timeout
@@ -31,10 +37,11 @@ class FileLocker:
             self.__folder, self.__filename = os.path.split(os.path.abspath(path))
 
         self.__pathLocker = None
-        self.__id = -1
+        self.__token = None
         self.__isLocked = False
         self.__start = None
-        self.__serverTimeLock = None
+        self.__serverTimeDelta = None
+        self.__inotify = None
 
         if not os.path.isdir(self.__folder):
             raise Exception(f"The specified path is not contained in an existing directory: '{path}'")
@@ -48,37 +55,120 @@ class FileLocker:
 
     @property
     def _serverTimeLock(self) -> datetime.datetime:
-        if self.__serverTimeLock is None:
-            tempPath = tempfile.NamedTemporaryFile(dir=self.__folder)
-            self.__serverTimeLock = datetime.datetime.fromtimestamp(os.path.getmtime(tempPath.name))
-            tempPath.close()
+        # the offset between the local clock and the file server one is measured once per lock session
+        if self.__serverTimeDelta is None:
+            with tempfile.NamedTemporaryFile(dir=self.__folder) as tempFile:
+                self.__serverTimeDelta = datetime.datetime.fromtimestamp(os.path.getmtime(tempFile.name)) - datetime.datetime.now()
+
+        return datetime.datetime.now() + self.__serverTimeDelta
+
+    @staticmethod
+    def __readToken(path: str) -> Optional[str]:
+        try:
+            with open(path) as lockFile:
+                return lockFile.read()
+
+        except OSError:
+            return None
+
+    def __isStale(self, path: str) -> bool:
+        serverTimeOtherLock = datetime.datetime.fromtimestamp(os.stat(path, follow_symlinks=False).st_mtime)
+        return self.timeout < (self._serverTimeLock - serverTimeOtherLock).total_seconds()
+
+    def __acquireGuard(self, pathGuard: str, blocking: bool) -> bool:
+        while True:
+            try:
+                os.close(os.open(pathGuard, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                return True
+
+            except FileExistsError:
+                pass
+
+            except OSError:
+                return False
+
+            try:
+                # the guard is only held for a check and a removal: an old one was left by a process which died meanwhile
+                if self.__isStale(pathGuard):
+                    os.remove(pathGuard)
+                    continue
+
+            except OSError:
+                # the guard has been released meanwhile
+                continue
+
+            if not blocking:
+                return False
+
+            time.sleep(FileLocker._GUARD_SLEEP_DURATION)
+
+    def __removeLockFile(self, pathLocker: str, shouldRemove: Callable[[str], bool], blocking: bool) -> None:
+        """
+        Removes the lock file if 'shouldRemove' is True for it.
+        All the removals (stale clean-ups and unlocks) are serialized by a guard file created with O_EXCL:
+            a new lock file can only appear once the previous one has been removed, so the file checked
+            by 'shouldRemove' is still the one removed.
+        """
+        pathGuard = FileLocker._GUARD_FORMAT.format(pathLocker)
+        if not self.__acquireGuard(pathGuard, blocking):
+            return
 
-        return self.__serverTimeLock
+        try:
+            if shouldRemove(pathLocker):
+                os.remove(pathLocker)
 
-    def __getLockFileIds(self) -> List[int]:
-        pattern = re.compile(FileLocker._LOCK_REGEX_FORMAT.format(self.__filename))
-        fileLockerMatches = [fileLockerMatch for fileLockerMatch in map(pattern.match, os.listdir(self.__folder)) if fileLockerMatch]
+        except OSError:
+            # the lock file has been released meanwhile
+            pass
 
-        # clean-ups lock files which are older than timeout (could be better implemented)
-        fullPaths = [os.path.join(self.__folder, fileLockerMatch.string) for fileLockerMatch in fileLockerMatches]
-        for path in fullPaths:
+        finally:
             try:
-                serverTimeOtherLock = datetime.datetime.fromtimestamp(os.path.getmtime(path))
-                if self.timeout < (self._serverTimeLock - serverTimeOtherLock).total_seconds():
-                    os.remove(path)
+                os.remove(pathGuard)
 
             except OSError:
-                # "os.remove": could not occur unless two process try to delete the same file at the same time
                 pass
 
-        return [int(fileLockerMatch.group("counter")) for fileLockerMatch in fileLockerMatches]
+    def __removeStaleLock(self, pathLocker: str) -> None:
+        # clean-ups the lock file if it is older than timeout (its owner probably died without unlocking)
+        try:
+            isStale = self.__isStale(pathLocker)
+
+        except OSError:
+            # the lock file has been released meanwhile
+            return
+
+        # staleness is checked again under the guard: another process may have broken the lock and taken it since
+        if isStale:
+            self.__removeLockFile(pathLocker, self.__isStale, blocking=False)
+
+    def __watchReleases(self) -> Optional["inotify_simple.INotify"]:
+        # returns None (polling) when inotify is exhausted, e.g. fs.inotify.max_user_instances or max_user_watches reached
+        try:
+            inotify = inotify_simple.INotify()
+
+        except OSError:
+            return None
+
+        try:
+            inotify.add_watch(self.__folder, inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM)
+
+        except OSError:
+            inotify.close()
+            return None
+
+        return inotify
 
-    def __sleep(self) -> None:
+    def __sleep(self, waitForRelease: bool = False) -> None:
         if self.__start + self.timeout < time.time():
             self.unlock()
             raise TimeoutError(f"Timeout reached after {self.timeout} seconds!")
 
-        time.sleep(0.5)
+        if waitForRelease and self.__inotify is not None:
+            # returns as soon as a file is removed from the folder, the timeout keeps the stale lock clean-up going
+            self.__inotify.read(timeout=int(FileLocker._SLEEP_DURATION * 1000))
+
+        else:
+            time.sleep(FileLocker._SLEEP_DURATION)
 
     def wrapWithDecorator(self, func: Optional[Callable[..., R]] = None, condition: Optional[Callable[..., bool]] = None) -> Callable[..., R]:
         """
@@ -147,34 +237,57 @@ class FileLocker:
         FileLocker.INSTANCES_LOCKED.add(self)
         self.__start = time.time()
         self.__isLocked = True
-        while self.__isLocked:
-            if not self.__getLockFileIds():
-                while self.__pathLocker is None or os.path.isfile(self.__pathLocker):
-                    self.__id = random.randrange(FileLocker._RAND_RANGE)
-                    lockname = FileLocker._LOCK_FORMAT.format(self.__filename, self.__id)
-                    self.__pathLocker = os.path.join(self.__folder, lockname)
-
+        # the folder is only watched once the lock is found busy: uncontended locks do not use any inotify instance
+        watchTried = inotify_simple is None
+        pathLocker = os.path.join(self.__folder, FileLocker._LOCK_FORMAT.format(self.__filename))
+        try:
+            while self.__isLocked:
                 try:
-                    open(self.__pathLocker, 'w').close()
+                    # O_EXCL makes the creation atomic: only one process can create the lock file
+                    lockFd = os.open(pathLocker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+
+                except FileExistsError:
+                    self.__removeStaleLock(pathLocker)
+                    if not watchTried:
+                        watchTried = True
+                        self.__inotify = self.__watchReleases()
+                        # the lock may have been released before the watch started: retry before waiting
+                        continue
+
+                    self.__sleep(waitForRelease=True)
 
-                except IOError:
-                    raise Exception(f"Cannot create the lock file: '{self.__pathLocker}'")
+                except OSError:
+                    raise Exception(f"Cannot create the lock file: '{pathLocker}'")
 
-                while True:
-                    self.__sleep()
-                    if min(self.__getLockFileIds()) == self.__id:
-                        self.__isLocked = False
-                        break
+                else:
+                    # the token identifies the owner: unlock only removes a lock file carrying its own token
+                    token = f"{os.getpid()}-{uuid.uuid4().hex}"
+                    try:
+                        os.write(lockFd, token.encode())
 
-            else:
-                self.__sleep()
+                    finally:
+                        os.close(lockFd)
+
+                    self.__pathLocker, self.__token = pathLocker, token
+                    self.__isLocked = False
+
+        finally:
+            if self.__inotify is not None:
+                self.__inotify.close()
+                self.__inotify = None
 
     def unlock(self) -> None:
         if self in FileLocker.INSTANCES_LOCKED:
             FileLocker.INSTANCES_LOCKED.remove(self)
 
-        if self.__pathLocker is not None and os.path.isfile(self.__pathLocker):
-            os.remove(self.__pathLocker)
+        # the lock file may have been removed as stale and taken by another process: only remove our own
+        if self.__pathLocker is not None and FileLocker.__readToken(self.__pathLocker) == self.__token:
+            self.__removeLockFile(self.__pathLocker, lambda path: FileLocker.__readToken(path) == self.__token, blocking=True)
+
+        # the lock file name is shared: never remove it again once released
+        self.__pathLocker = None
+        self.__token = None
+        self.__serverTimeDelta = None
 
 
 def __unlockall() -> None:
@@ -0,0 +1,17 @@
+# coding: UTF-8
+"""
+Numba implementations of the kernels of indexkernels.py.
+This module imports numba: it is only imported by indexkernels, on first use.
+"""
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, cache=True)
+def applyPermutation(mat: np.ndarray, perm: np.ndarray, out: np.ndarray) -> np.ndarray:
+    for i in numba.prange(perm.shape[0]):
+        srcRow = perm[i]
+        for j in range(perm.shape[0]):
+            out[i, j] = mat[srcRow, perm[j]]
+
+    return out